@@ -1,6 +1,16 @@
 (function(){
+    // Image formats collected from cell outputs, in order of preference
+    var IMAGE_FORMATS = ["image/png", "image/jpeg", "image/svg+xml"];
+    
+    // Slideshow types accepted by set_slideshow_type
+    var SLIDESHOW_TYPES = new Set(["slide", "subslide", "fragment", "skip", "notes", null, "-"]);
+    
+    // How long a streamed run of all cells may take, matching the external
+    // client's timeout for run_all_cells
+    var RUN_ALL_CELLS_TIMEOUT_MS = 600000;
+    
     // Connect to WebSocket server
-    var ws = new WebSocket("ws://localhost:%s");
+    var ws = new WebSocket("ws://localhost:__WS_PORT__");
     
     ws.onopen = function() {
         // Identify as notebook client
@@ -11,6 +21,11 @@
     ws.onmessage = function(event) {
         var data = JSON.parse(event.data);
         
+        // The server may coalesce several messages into one array frame
+        (Array.isArray(data) ? data : [data]).forEach(handleMessage);
+    };
+
+    function handleMessage(data) {
         // Handle different action types
         switch(data.type) {
             case "insert_and_execute_cell":
@@ -25,6 +40,9 @@
             case "get_notebook_info":
                 handleGetNotebookInfo(data);
                 break;
+            case "get_state":
+                handleGetState(data);
+                break;
             case "run_cell":
                 handleRunCell(data);
                 break;
@@ -46,7 +64,7 @@
             default:
                 console.warn("Unknown message type:", data.type);
         }
-    };
+    }
 
     function sendError(responseType, request_id, error, logMessage) {
         var errorResponse = {
@@ -134,21 +152,35 @@
         }
     }
     
+    function collectCellsInfo() {
+        return Jupyter.notebook.get_cells().map(function(cell, index) {
+            return {
+                id: cell.cell_id || "cell_" + index,
+                position: index,
+                content: cell.get_text(),
+                type: cell.cell_type,
+                prompt_number: cell.input_prompt_number,
+            };
+        });
+    }
+    
+    function collectNotebookInfo() {
+        return {
+            notebook_name: Jupyter.notebook.notebook_name,
+            notebook_path: Jupyter.notebook.notebook_path,
+            kernel_name: Jupyter.notebook.kernel.name,
+            cell_count: Jupyter.notebook.get_cells().length,
+            modified: Jupyter.notebook.dirty,
+            trusted: Jupyter.notebook.trusted
+        };
+    }
+    
     // Handle getting information about all cells
     function handleGetCellsInfo(data) {
         var request_id = data.request_id;
         
         try {
-            var cells = Jupyter.notebook.get_cells();
-            var cellsInfo = cells.map(function(cell, index) {
-                return {
-                    id: cell.cell_id || "cell_" + index,
-                    position: index,
-                    content: cell.get_text(),
-                    type: cell.cell_type,
-                    prompt_number: cell.input_prompt_number,
-                };
-            });
+            var cellsInfo = collectCellsInfo();
             
             var response = {
                 type: "cells_info_result",
@@ -171,14 +203,7 @@
         var request_id = data.request_id;
         
         try {
-            var nbInfo = {
-                notebook_name: Jupyter.notebook.notebook_name,
-                notebook_path: Jupyter.notebook.notebook_path,
-                kernel_name: Jupyter.notebook.kernel.name,
-                cell_count: Jupyter.notebook.get_cells().length,
-                modified: Jupyter.notebook.dirty,
-                trusted: Jupyter.notebook.trusted
-            };
+            var nbInfo = collectNotebookInfo();
             
             var response = {
                 type: "notebook_info_result",
@@ -196,6 +221,33 @@
         }
     }
     
+    // Handle getting notebook and cells information in one response
+    function handleGetState(data) {
+        var request_id = data.request_id;
+        var fields = data.fields || ["notebook", "cells"];
+        
+        try {
+            var response = {
+                type: "get_state_result",
+                request_id: request_id,
+                source: "notebook",
+                target: "external",
+                status: "success"
+            };
+            if (fields.indexOf("notebook") !== -1) {
+                response.notebook_info = collectNotebookInfo();
+            }
+            if (fields.indexOf("cells") !== -1) {
+                response.cells = collectCellsInfo();
+            }
+            
+            ws.send(JSON.stringify(response));
+            console.log("Sent notebook state (" + fields.join(", ") + ")");
+        } catch (error) {
+            sendError("get_state_result", request_id, error, "Error getting notebook state:");
+        }
+    }
+    
     // Handle running a specific cell by index
     function handleRunCell(data) {
         var request_id = data.request_id;
@@ -246,6 +298,11 @@
         var request_id = data.request_id;
         
         try {
+            if (data.stream) {
+                streamRunAllCells(request_id);
+                return;
+            }
+            
             Jupyter.notebook.restart_run_all();
             
             var response = {
@@ -263,6 +320,82 @@
         }
     }
 
+    // Run all cells, sending a progress event as each code cell finishes and a
+    // final result once all of them have run
+    function streamRunAllCells(request_id) {
+        var events = Jupyter.notebook.events;
+        // Only the cells of this run are counted, so executions started
+        // elsewhere neither report progress nor end the stream early
+        var pending = new Set(Jupyter.notebook.get_cells().filter(function(cell) {
+            return cell.cell_type === "code";
+        }));
+        var timer = null;
+        
+        var stop = function() {
+            events.off("finished_execute.CodeCell", onFinished);
+            clearTimeout(timer);
+        };
+        
+        var sendComplete = function() {
+            ws.send(JSON.stringify({
+                type: "run_all_cells_result",
+                request_id: request_id,
+                status: "complete",
+                source: "notebook",
+                target: "external",
+            }));
+            console.log("All cells finished running");
+        };
+        
+        var onFinished = function(event, eventData) {
+            var cell = eventData.cell;
+            if (!pending.delete(cell)) {
+                return;
+            }
+            var outputs = extractCellOutputContent(cell, 1500);
+            ws.send(JSON.stringify({
+                type: "run_all_cells_progress",
+                request_id: request_id,
+                status: "running",
+                source: "notebook",
+                target: "external",
+                index: Jupyter.notebook.find_cell_index(cell),
+                output_text: outputs.text,
+                is_truncated: outputs.is_text_truncated,
+                has_images: outputs.images.length > 0,
+            }));
+            
+            if (pending.size === 0) {
+                stop();
+                sendComplete();
+            }
+        };
+        
+        var onError = function(error) {
+            stop();
+            sendError("run_all_cells_result", request_id, error, "Error running all cells:");
+        };
+        
+        if (pending.size === 0) {
+            Jupyter.notebook.restart_run_all();
+            sendComplete();
+            return;
+        }
+        events.on("finished_execute.CodeCell", onFinished);
+        // A cancelled restart never runs the cells, so give up after as long
+        // as the external client waits for the whole run
+        timer = setTimeout(function() {
+            onError(new Error("Timed out waiting for all cells to run"));
+        }, RUN_ALL_CELLS_TIMEOUT_MS);
+        try {
+            Promise.resolve(Jupyter.notebook.restart_run_all()).catch(onError);
+        } catch (error) {
+            onError(error);
+            return;
+        }
+        console.log("Running all cells, streaming progress");
+    }
+
     // Handle getting output from a specific cell
     function handleGetCellTextOutput(data) {
         var request_id = data.request_id;
@@ -400,8 +533,7 @@
             
             var cell = cells[index];
             
-            var valid_types = ["slide", "subslide", "fragment", "skip", "notes", null, "-"];
-            if (!valid_types.includes(slideshow_type)) {
+            if (!SLIDESHOW_TYPES.has(slideshow_type)) {
                 slideshow_type = null;
             }
             
@@ -438,6 +570,37 @@
         }
     }
 
+    // Collect the plain text and images of a rich output
+    function collectOutputData(output, result) {
+        var data = output.data;
+        if (!data) {
+            return;
+        }
+        if (data["text/plain"]) {
+            result.text += data["text/plain"];
+        }
+        for (const format of IMAGE_FORMATS) {
+            if (data[format]) {
+                result.images.push({
+                    format: format,
+                    data: data[format]
+                });
+            }
+        }
+    }
+    
+    // How each output type adds to the extracted content
+    var OUTPUT_HANDLERS = {
+        stream: function(output, result) {
+            result.text += output.text || "";
+        },
+        execute_result: collectOutputData,
+        display_data: collectOutputData,
+        error: function(output, result) {
+            result.text += output.ename + ": " + output.evalue + "\n";
+        }
+    };
+    
     // Utility function to extract text output from a cell
     function extractCellOutputContent(cell, maxTextLength) {
         var result = {
@@ -448,21 +611,9 @@
         
         if (cell.cell_type === "code" && cell.output_area && cell.output_area.outputs) {
             cell.output_area.outputs.forEach(function(output) {
-                if (output.text) {
-                    result.text += output.text;
-                } else if (output.data && output.data["text/plain"]) {
-                    result.text += output.data["text/plain"];
-                }
-                
-                if (output.data) {
-                    for (const format of ["image/png", "image/jpeg", "image/svg+xml"]) {
-                        if (output.data[format]) {
-                            result.images.push({
-                                format: format,
-                                data: output.data[format]
-                            });
-                        }
-                    }
+                var handler = OUTPUT_HANDLERS[output.output_type];
+                if (handler) {
+                    handler(output, result);
                 }
             });
             
@@ -3,13 +3,22 @@
 Jupyter Notebook MCP Server - MCP server that connects to a Jupyter notebook via WebSockets
 """
 
-import json
+import asyncio
+import functools
+import inspect
 import logging
+import os
 from contextlib import asynccontextmanager
 from typing import AsyncIterator, Dict, Any
 from mcp.server.fastmcp import FastMCP, Context
 import mcp.types as types
-from jupyter_ws_client import get_jupyter_client
+from jupyter_ws_client import DEFAULT_POOL_SIZE, close_jupyter_clients, get_jupyter_client, has_open_client
+from jupyter_ws_json import dumps, dumps_pretty, loads
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -18,16 +27,17 @@ logger = logging.getLogger("JupyterMCPServer")
 @asynccontextmanager
 async def server_lifespan(server: FastMCP) -> AsyncIterator[Dict[str, Any]]:
     """Manage server startup and shutdown lifecycle"""
-    import os
     ws_host = os.environ.get("JUPYTER_WS_HOST", "localhost")
     ws_port = int(os.environ.get("JUPYTER_WS_PORT", "8765"))
+    ws_pool_size = int(os.environ.get("JUPYTER_WS_POOL_SIZE", DEFAULT_POOL_SIZE))
+    ws_uds = os.environ.get("JUPYTER_WS_UDS") or None
     
     try:
         logger.info("JupyterMCPServer starting up")
         
         # Try to connect to Jupyter WebSocket server on startup
         try:
-            await get_jupyter_client(host=ws_host, port=ws_port)
+            await get_jupyter_client(host=ws_host, port=ws_port, pool_size=ws_pool_size, uds=ws_uds)
             logger.info("Successfully connected to Jupyter WebSocket server on startup")
         except Exception as e:
             logger.warning(f"Could not connect to Jupyter WebSocket server on startup: {str(e)}")
@@ -35,11 +45,9 @@ async def server_lifespan(server: FastMCP) -> AsyncIterator[Dict[str, Any]]:
         
         yield {}
     finally:
-        # Clean up the client on shutdown
-        client = await get_jupyter_client(host=ws_host, port=ws_port)
-        if client:
-            logger.info("Disconnecting from Jupyter WebSocket server on shutdown")
-            await client.disconnect()
+        # Clean up the clients on shutdown
+        logger.info("Disconnecting from Jupyter WebSocket server on shutdown")
+        await close_jupyter_clients()
         logger.info("JupyterMCPServer shut down")
 
 # Create the MCP server
@@ -49,23 +57,73 @@ mcp = FastMCP(
     lifespan=server_lifespan
 )
 
+# Tool responses are compact JSON; JUPYTER_MCP_PRETTY=1 indents them for reading
+PRETTY_RESPONSES = os.environ.get("JUPYTER_MCP_PRETTY") == "1"
+
+if PRETTY_RESPONSES:
+    _ERR_PREFIX, _ERR_SUFFIX = '{\n  "status": "error",\n  "message": ', '\n}'
+else:
+    _ERR_PREFIX, _ERR_SUFFIX = '{"status":"error","message":', '}'
+
+def _err(message: str) -> str:
+    """Tool error response, with only the message encoded per call"""
+    return _ERR_PREFIX + dumps(message).decode() + _ERR_SUFFIX
+
+def _ok(result) -> str:
+    """Tool response for a result, which may already be JSON text"""
+    if isinstance(result, str):
+        # Raw results are passed on as received unless they are to be indented
+        return dumps_pretty(loads(result)) if PRETTY_RESPONSES else result
+    return dumps_pretty(result) if PRETTY_RESPONSES else dumps(result).decode()
+
+def _tool(fn):
+    """Turn a coroutine taking a Jupyter client into an MCP tool body
+    
+    The wrapper gets a pooled client, encodes the result, and reports any
+    exception as an error response. Its signature replaces the client
+    parameter with the MCP context, so FastMCP sees the tool arguments only.
+    """
+    signature = inspect.signature(fn)
+    
+    @functools.wraps(fn)
+    async def wrapper(ctx: Context, *args, **kwargs) -> str:
+        try:
+            client = await get_jupyter_client()
+            return _ok(await fn(client, *args, **kwargs))
+        except Exception as e:
+            return _err(str(e))
+    
+    ctx_param = inspect.Parameter("ctx", inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=Context)
+    wrapper.__signature__ = signature.replace(
+        parameters=[ctx_param, *list(signature.parameters.values())[1:]],
+        return_annotation=str,
+    )
+    return wrapper
+
+# Reply to ping, built once
+PING_SUCCESS = dumps({"status": "success", "message": "Connected to Jupyter WebSocket server"}).decode()
+
 @mcp.tool()
 async def ping(ctx: Context) -> str:
     """Simple ping command to check server connectivity"""
+    # An open pooled connection already answers the question
+    if has_open_client():
+        return PING_SUCCESS
     try:
         _ = await get_jupyter_client()
-        return json.dumps({"status": "success", "message": "Connected to Jupyter WebSocket server"})
+        return PING_SUCCESS
     except Exception as e:
-        return json.dumps({"status": "error", "message": str(e)})
+        return dumps({"status": "error", "message": str(e)}).decode()
 
 @mcp.tool()
+@_tool
 async def insert_and_execute_cell(
-        ctx: Context, cell_type:
-        str = "code",
+        client,
+        cell_type: str = "code",
         position: int = 1,
         content: str = "",
         slideshow_type=None,
-    ) -> str:
+    ):
     """Insert a cell at the specified position and execute it, and optionally set slideshow type.
     If code cell, it will be executed.
     If markdown cell, it will be rendered.
@@ -76,103 +134,54 @@ async def insert_and_execute_cell(
         content: The content of the cell
         slideshow_type: Optional slideshow type ('slide', 'subslide', 'fragment', 'skip', 'notes')
     """
-    try:
-        client = await get_jupyter_client()
-        result = await client.insert_and_execute_cell(cell_type, position, content, slideshow_type)
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({
-            "status": "error",
-            "message": str(e)
-        }, indent=2)
+    return await client.insert_and_execute_cell(cell_type, position, content, slideshow_type)
 
 @mcp.tool()
-async def save_notebook(ctx: Context) -> str:
+@_tool
+async def save_notebook(client):
     """Save the current Jupyter notebook"""
-    try:
-        client = await get_jupyter_client()
-        result = await client.save_notebook()
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({
-            "status": "error",
-            "message": str(e)
-        }, indent=2)
+    return await client.save_notebook()
 
 @mcp.tool()
-async def get_cells_info(ctx: Context) -> str:
+@_tool
+async def get_cells_info(client):
     """Get information about all cells in the notebook"""
-    try:
-        client = await get_jupyter_client()
-        result = await client.get_cells_info()
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({
-            "status": "error",
-            "message": str(e)
-        }, indent=2)
+    return await client.get_cells_info()
 
 @mcp.tool()
-async def get_notebook_info(ctx: Context) -> str:
+@_tool
+async def get_notebook_info(client):
     """Get information about the current Jupyter notebook"""
-    try:
-        client = await get_jupyter_client()
-        result = await client.get_notebook_info()
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({
-            "status": "error",
-            "message": str(e)
-        }, indent=2)
+    return await client.get_notebook_info()
 
 @mcp.tool()
-async def run_cell(ctx: Context, index: int) -> str:
+@_tool
+async def run_cell(client, index: int):
     """Run a specific cell by its index
     
     Args:
         index: The index of the cell to run
     """
-    try:
-        client = await get_jupyter_client()
-        result = await client.run_cell(index)
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({
-            "status": "error",
-            "message": str(e)
-        }, indent=2)
+    # Cell outputs can be large; pass the notebook's JSON through unparsed
+    return await client.run_cell(index, raw=True)
 
 @mcp.tool()
-async def run_all_cells(ctx: Context) -> str:
+@_tool
+async def run_all_cells(client):
     """Restart and run all cells in the notebook.
     You need to wait for user approval"""
-    try:
-        client = await get_jupyter_client()
-        result = await client.run_all_cells()
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({
-            "status": "error",
-            "message": str(e)
-        }, indent=2)
+    return await client.run_all_cells(raw=True)
 
 @mcp.tool()
-async def get_cell_text_output(ctx: Context, index: int, max_length: int = 1500) -> str:
+@_tool
+async def get_cell_text_output(client, index: int, max_length: int = 1500):
     """Get the text output content of a specific code cell by its index
     
     Args:
         index: The index of the cell to get output from
         max_length: Maximum length of text output to return (default: 1500 characters)
     """
-    try:
-        client = await get_jupyter_client()
-        result = await client.send_request("get_cell_text_output", index=index, max_length=max_length)
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({
-            "status": "error",
-            "message": str(e)
-        }, indent=2)
+    return await client.get_cell_text_output(index, max_length, raw=True)
 
 @mcp.tool()
 async def get_image_output(ctx: Context, index: int) -> list[types.ImageContent]:
@@ -187,29 +196,29 @@ async def get_image_output(ctx: Context, index: int) -> list[types.ImageContent]
     try:
         client = await get_jupyter_client()
         result = await client.get_image_output(index)
+        if result.get("status") != "success":
+            return []
         
+        # The base64 strings from the decoded result are handed over as they
+        # are; a malformed entry is skipped without losing the other images
         images = []
-        if result.get("status") == "success":
-            for i, img_data in enumerate(result.get("images", [])):
-                try:
-                    format_raw = img_data.get("format", "image/png")
-                    format_name = format_raw.split("/")[1]
-                    mcp_image = types.ImageContent(
-                        type="image",
-                        data=img_data.get("data", ""),
-                        mimeType=f"image/{format_name}",
-                    )
-                    images.append(mcp_image)
-                except Exception as e:
-                    logger.error(f"Error processing image {i}: {str(e)}")
-        
+        for i, img_data in enumerate(result.get("images", [])):
+            try:
+                images.append(types.ImageContent(
+                    type="image",
+                    data=img_data.get("data", ""),
+                    mimeType="image/" + img_data.get("format", "image/png").split("/", 1)[-1],
+                ))
+            except Exception as e:
+                logger.error(f"Error processing image {i}: {str(e)}")
         return images
     except Exception as e:
         logger.error(f"Error in get_image_output: {e}")
         return []
 
 @mcp.tool()
-async def edit_cell_content(ctx: Context, index: int, content: str, execute: bool = True) -> str:
+@_tool
+async def edit_cell_content(client, index: int, content: str, execute: bool = True):
     """Edit the content of a specific cell by its index and optionally execute it
     
     Args:
@@ -217,22 +226,16 @@ async def edit_cell_content(ctx: Context, index: int, content: str, execute: boo
         content: The new content for the cell
         execute: If True and the cell is code, execute after editing and return output
     """
-    try:
-        client = await get_jupyter_client()
-        result = await client.edit_cell_content(
-            index=index,
-            content=content,
-            execute=execute
-        )
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({
-            "status": "error",
-            "message": str(e)
-        }, indent=2)
+    return await client.edit_cell_content(
+        index=index,
+        content=content,
+        execute=execute,
+        raw=True,
+    )
 
 @mcp.tool()
-async def set_slideshow_type(ctx: Context, index: int, slideshow_type: str = "") -> str:
+@_tool
+async def set_slideshow_type(client, index: int, slideshow_type: str = ""):
     """Set the slideshow type for a specific cell by its index
     
     Args:
@@ -245,19 +248,10 @@ async def set_slideshow_type(ctx: Context, index: int, slideshow_type: str = "")
                         "notes" - Speaker notes
                         "-" or null - Remove slideshow type
     """
-    try:
-        client = await get_jupyter_client()
-        result = await client.set_slideshow_type(index=index, slideshow_type=slideshow_type)
-        return json.dumps(result, indent=2)
-    except Exception as e:
-        return json.dumps({
-            "status": "error",
-            "message": str(e)
-        }, indent=2)
+    return await client.set_slideshow_type(index=index, slideshow_type=slideshow_type)
 
 def main():
     """Run the MCP server"""
-    import os
     import argparse
     
     parser = argparse.ArgumentParser(description="Jupyter MCP Server")
@@ -267,15 +261,27 @@ def main():
                         help="Host of the WebSocket server running in Jupyter")
     parser.add_argument("--ws-port", type=int, default=8765,
                         help="Port of the WebSocket server running in Jupyter")
+    parser.add_argument("--ws-pool-size", type=int,
+                        default=int(os.environ.get("JUPYTER_WS_POOL_SIZE", DEFAULT_POOL_SIZE)),
+                        help="Number of WebSocket connections shared by concurrent tool calls")
+    parser.add_argument("--ws-uds", type=str, default=os.environ.get("JUPYTER_WS_UDS"),
+                        help="Unix socket of the WebSocket server, used instead of TCP when it exists")
     args = parser.parse_args()
     
     # Set environment variables for the lifespan to use
     os.environ["JUPYTER_WS_HOST"] = args.ws_host
     os.environ["JUPYTER_WS_PORT"] = str(args.ws_port)
+    os.environ["JUPYTER_WS_POOL_SIZE"] = str(args.ws_pool_size)
+    if args.ws_uds:
+        os.environ["JUPYTER_WS_UDS"] = args.ws_uds
     
     logger.info(f"Starting Jupyter MCP server on port {args.port}")
     logger.info(f"Connecting to Jupyter WebSocket server at {args.ws_host}:{args.ws_port}")
     
+    # The server is WebSocket I/O bound; uvloop's event loop handles that faster
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    
     mcp.run()
 
 if __name__ == "__main__":
@@ -1,39 +1,210 @@
 import asyncio
-import json
 import logging
+import os
+import socket
 import websockets
 from typing import Optional
+from websockets.protocol import State
+from jupyter_ws_json import dumps, loads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("JupyterWebSocketClient")
 
+# Connection options matching the server side: no limit on queued incoming frames,
+# room for large cell outputs, and keepalive pings to detect dead connections.
+# Per-message deflate is offered for large JSON outputs; it is only used when
+# the server was started with compression enabled.
+WS_CONNECT_OPTIONS = {
+    "max_queue": None,
+    "max_size": 2**26,
+    "write_limit": 2**20,
+    "compression": "deflate",
+    "ping_interval": 20,
+    "ping_timeout": 10,
+}
+
+# Seconds to wait for the server to acknowledge a requested encoding
+ENCODING_ACK_TIMEOUT = 2.0
+
+# Reconnect attempts made by a request that finds the connection down, and the
+# delays between them: doubling from the first, up to the maximum (seconds)
+RECONNECT_ATTEMPTS = 5
+RECONNECT_BASE_DELAY = 0.1
+RECONNECT_MAX_DELAY = 2.0
+
+# Maximum number of received frames waiting to be decoded
+INBOX_SIZE = 256
+
+# Queued outgoing messages are merged into one frame up to about this many bytes
+MAX_BATCH_BYTES = 2**16
+
+# Time the writer waits for more messages once several are queued (seconds)
+BATCH_WINDOW = 0.005
+
+# Seconds to wait for the result of a request. Metadata calls answer quickly,
+# while executing the whole notebook can legitimately take minutes.
+DEFAULT_REQUEST_TIMEOUT = 60.0
+
+# Maximum number of requests a client has waiting for a result at once
+MAX_IN_FLIGHT = 256
+
+# Requests that do not change the notebook. Identical ones in flight at the same
+# time share a single round trip; any other request starts fresh reads.
+READ_ONLY_REQUESTS = frozenset({"get_cells_info", "get_notebook_info", "get_state"})
+REQUEST_TIMEOUTS = {
+    "save_notebook": 10.0,
+    "get_cells_info": 10.0,
+    "get_notebook_info": 10.0,
+    "get_state": 10.0,
+    "get_cell_text_output": 10.0,
+    "get_cell_image_output": 10.0,
+    "set_slideshow_type": 10.0,
+    "run_all_cells": 600.0,
+}
+
+# Interval between sweeps that drop pending requests nobody is waiting on anymore
+# (seconds). An entry is dropped once twice its timeout has passed.
+PENDING_SWEEP_INTERVAL = 5.0
+
+# Key located by peek_request_id in a serialized message
+REQUEST_ID_KEY = b'"request_id":'
+
+# Routing fields of every request, and their JSON encoding up to the request_id
+# value; _send_message appends the id and the encoded request after it
+REQUEST_HEADER = {"source": "external", "target": "notebook"}
+REQUEST_HEADER_JSON = b'{"source":"external","target":"notebook","request_id":'
+
+def peek_request_id(frame):
+    """Read the integer request_id of a single JSON message without parsing the frame
+    
+    The notebook writes request_id ahead of the (possibly large) outputs, so
+    the first occurrence is the message's own. Returns None when the frame
+    is a batch or the id cannot be read this way.
+    """
+    if frame[:1] != b"{":
+        return None
+    index = frame.find(REQUEST_ID_KEY)
+    if index < 0:
+        return None
+    start = index + len(REQUEST_ID_KEY)
+    end = frame.find(b",", start)
+    if end < 0:
+        end = frame.find(b"}", start)
+    try:
+        return int(frame[start:end])
+    except ValueError:
+        return None
+
 class JupyterWebSocketClient:
-    """Client that connects to the Jupyter WebSocket server"""
+    """Client that connects to the Jupyter WebSocket server
+    
+    With encoding="msgpack" the client asks the server for MessagePack binary
+    frames and falls back to JSON if the server (or this environment) does
+    not support it.
+    """
     
-    def __init__(self, host='localhost', port=8765):
+    def __init__(self, host='localhost', port=8765, encoding="json", uds=None):
         self.host = host
         self.port = port
+        self.encoding = encoding
+        # Unix domain socket of the server, used instead of TCP while it exists
+        self.uds = uds
+        self.active_encoding = "json"
         self.websocket = None
         self.connected = False
         self.pending_requests = {}
+        # Queues receiving the events of streamed requests, by request_id
+        self.stream_requests = {}
+        # Ids of pending requests whose result is returned as JSON text
+        self.raw_requests = set()
+        # Loop time after which each pending request is dropped by the sweeper
+        self._request_deadlines: dict[int, float] = {}
+        self._sweeper = None
+        # Background tasks of the current connection, kept so they can be stopped
+        self._listener_task = None
+        self._worker_task = None
+        self._writer_task = None
+        # Reconnects in the background once the connection drops
+        self._supervisor = None
+        # Outgoing messages waiting for the writer task, with the future that
+        # reports when each one has been sent
+        self._outbox = None
+        # Integer request ids. The counter starts at a random offset so ids from
+        # the different external clients sharing a server do not collide, and
+        # stays below 2**53 so JavaScript can represent it exactly.
+        self._next_id = int.from_bytes(os.urandom(4), "big") << 20
+        # Serializes connection attempts, so concurrent requests that find the
+        # connection down wait for one reconnect instead of racing their own
+        self._connect_lock = asyncio.Lock()
+        # Caps the requests waiting for a result; further callers wait for a slot
+        self._in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        # Read-only requests in flight, by their encoded request, shared by callers
+        self._shared_reads: dict[bytes, asyncio.Task] = {}
     
     async def connect(self):
         """Connect to the Jupyter WebSocket server"""
+        async with self._connect_lock:
+            return await self._connect()
+    
+    async def _connect(self):
+        """Open the connection and start its background tasks; callers hold _connect_lock"""
         if self.connected:
             return True
             
+        # Keep a single connection per client: drop a stale one, and its
+        # background tasks, before reconnecting
+        await self._stop_tasks()
+        if self.websocket is not None:
+            await self.websocket.close()
+            self.websocket = None
+        # Requests sent over the old connection will not be answered
+        self._reject_pending(Exception("WebSocket connection closed"))
+        
         try:
             uri = f"ws://{self.host}:{self.port}"
-            self.websocket = await websockets.connect(uri)
+            if self.uds is not None and os.path.exists(self.uds):
+                try:
+                    self.websocket = await websockets.unix_connect(self.uds, uri, **WS_CONNECT_OPTIONS)
+                    uri = f"{uri} through {self.uds}"
+                except OSError as e:
+                    # A socket file left by a server that is gone refuses
+                    # connections; the relay also listens on TCP
+                    logger.warning(f"Could not connect through {self.uds}, using TCP: {str(e)}")
+            if self.websocket is None:
+                self.websocket = await websockets.connect(uri, **WS_CONNECT_OPTIONS)
+            self._set_nodelay()
             
             # Identify as an external client
-            await self.websocket.send(json.dumps({"role": "external"}))
+            init_msg = {"role": "external"}
+            if self.encoding == "msgpack":
+                if msgpack is not None:
+                    init_msg["encoding"] = "msgpack"
+                else:
+                    logger.warning("msgpack is not installed, using JSON frames")
+            await self.websocket.send(dumps(init_msg))
+            self.active_encoding = "json"
+            if "encoding" in init_msg:
+                self.active_encoding = await self._negotiate_encoding()
             
-            # Start listening for messages in the background
-            asyncio.create_task(self._listen_for_messages())
+            # Read and process messages in the background, through a bounded inbox
+            inbox = asyncio.Queue(maxsize=INBOX_SIZE)
+            self._listener_task = asyncio.create_task(
+                self._listen_for_messages(inbox), name="jupyter-ws-listener")
+            self._worker_task = asyncio.create_task(
+                self._process_messages(inbox), name="jupyter-ws-worker")
+            self._outbox = asyncio.Queue()
+            self._writer_task = asyncio.create_task(
+                self._write_messages(self._outbox), name="jupyter-ws-writer")
             
             self.connected = True
+            if self._supervisor is None or self._supervisor.done():
+                self._supervisor = asyncio.create_task(self._supervise(), name="jupyter-ws-supervisor")
             logger.info(f"Connected to Jupyter WebSocket server at {uri}")
             return True
         except Exception as e:
@@ -41,102 +212,454 @@ class JupyterWebSocketClient:
             self.connected = False
             return False
     
+    def _set_nodelay(self):
+        """Disable Nagle's algorithm so small requests are not held back by the kernel
+        
+        asyncio normally does this for TCP connections; it is set explicitly so
+        every event loop behaves the same.
+        """
+        sock = self.websocket.transport.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    async def reconnect(self):
+        """Reconnect with exponential backoff, returning whether it succeeded"""
+        async with self._connect_lock:
+            delay = RECONNECT_BASE_DELAY
+            for attempt in range(RECONNECT_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                # Returns right away if another request already reconnected
+                if await self._connect():
+                    return True
+            return False
+    
+    async def _supervise(self):
+        """Background task reconnecting, with backoff, as soon as the connection drops
+        
+        Requests that arrive meanwhile wait for this reconnect on the connect
+        lock instead of starting their own. When every attempt fails the task
+        ends, and the next request tries again.
+        """
+        while True:
+            listener = self._listener_task
+            if listener is not None:
+                # The listener ends when the connection closes
+                await asyncio.wait([listener])
+            if not self.connected:
+                logger.info("Connection lost, reconnecting in the background...")
+            if not await self.reconnect():
+                logger.error("Could not reconnect to Jupyter WebSocket server")
+                return
+    
+    async def _negotiate_encoding(self):
+        """Wait for the server to acknowledge the requested encoding"""
+        try:
+            reply = loads(await asyncio.wait_for(self.websocket.recv(), ENCODING_ACK_TIMEOUT))
+        except (asyncio.TimeoutError, ValueError):
+            reply = None
+        
+        if isinstance(reply, dict) and reply.get("type") == "encoding_ack":
+            return reply.get("encoding", "json")
+        logger.warning("Server did not acknowledge MessagePack encoding, using JSON frames")
+        return "json"
+    
+    async def _send_message(self, message, request_id):
+        """Address a request to the notebook, encode it with the negotiated encoding and wait until it is sent"""
+        if self.active_encoding == "msgpack":
+            payload = msgpack.packb({**REQUEST_HEADER, "request_id": request_id, **message})
+        else:
+            # The routing fields never change, so only the request itself is encoded
+            payload = REQUEST_HEADER_JSON + b"%d," % request_id + dumps(message)[1:]
+        if self._outbox is None:
+            raise websockets.exceptions.ConnectionClosed(None, None)
+        sent = asyncio.get_running_loop().create_future()
+        self._outbox.put_nowait((payload, sent))
+        await sent
+    
+    async def _write_messages(self, outbox):
+        """Background task sending queued messages, merging those that pile up
+        
+        A JSON batch is sent as one array frame and a MessagePack batch as the
+        concatenated objects, the same framing the server uses.
+        """
+        websocket = self.websocket
+        while True:
+            batch = [await outbox.get()]
+            size = len(batch[0][0])
+            try:
+                # A lone message goes out right away. Messages piling up mean a
+                # burst is under way, so wait once, briefly, for the rest of it.
+                waited = False
+                while True:
+                    while size < MAX_BATCH_BYTES and not outbox.empty():
+                        batch.append(outbox.get_nowait())
+                        size += len(batch[-1][0])
+                    if waited or len(batch) == 1 or size >= MAX_BATCH_BYTES:
+                        break
+                    await asyncio.sleep(BATCH_WINDOW)
+                    waited = True
+                
+                payloads = [payload for payload, _ in batch]
+                # Encoded messages are sent as binary frames, as they are
+                if self.active_encoding == "msgpack":
+                    await websocket.send(b"".join(payloads))
+                elif len(payloads) == 1:
+                    await websocket.send(payloads[0])
+                else:
+                    await websocket.send(b"[" + b",".join(payloads) + b"]")
+            except asyncio.CancelledError:
+                self._fail_sends(batch)
+                raise
+            except Exception as e:
+                self._fail_sends(batch, e)
+                continue
+            
+            for _, sent in batch:
+                if not sent.done():
+                    sent.set_result(None)
+    
+    def _fail_sends(self, batch, error=None):
+        """Report queued messages as not sent, as a closed connection by default"""
+        for _, sent in batch:
+            if not sent.done():
+                sent.set_exception(error or websockets.exceptions.ConnectionClosed(None, None))
+    
+    def _decode_frame(self, frame):
+        """Decode a frame into the list of messages it carries"""
+        if self.active_encoding == "msgpack":
+            # Batches are concatenated MessagePack objects
+            unpacker = msgpack.Unpacker()
+            unpacker.feed(frame)
+            return list(unpacker)
+        
+        # The server may coalesce several messages into one JSON array frame
+        data = loads(frame)
+        return data if isinstance(data, list) else [data]
+    
+    async def _stop_tasks(self):
+        """Cancel the connection's background tasks and wait for them to finish"""
+        tasks = [task for task in (self._listener_task, self._worker_task, self._writer_task)
+                 if task is not None and not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._listener_task = None
+        self._worker_task = None
+        self._writer_task = None
+        
+        # Messages still queued will never be sent
+        if self._outbox is not None:
+            while not self._outbox.empty():
+                self._fail_sends([self._outbox.get_nowait()])
+            self._outbox = None
+    
     async def disconnect(self):
         """Disconnect from the WebSocket server"""
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
         if self.websocket:
+            self.connected = False
             await self.websocket.close()
             self.websocket = None
-            self.connected = False
+        await self._stop_tasks()
+        self._reject_pending(Exception("WebSocket connection closed"))
     
-    async def _listen_for_messages(self):
-        """Background task to listen for messages from the WebSocket server"""
+    async def _listen_for_messages(self, inbox):
+        """Background task to read frames from the WebSocket server into the inbox
+        
+        When the inbox is full the task stops reading, which lets the pressure
+        build up on the server's side of the connection instead of in memory.
+        The task ends by queueing the error that closed the connection.
+        """
+        websocket = self.websocket
         try:
-            async for message in self.websocket:
-                try:
-                    data = json.loads(message)
-                    
-                    # Process messages directed to us (external client)
-                    request_id = data.get("request_id")
-                    if request_id in self.pending_requests:
-                        # Resolve the future with the result
-                        future = self.pending_requests.pop(request_id)
-                        future.set_result(data)
-                    elif data.get("type") == "error" and request_id in self.pending_requests:
-                        # Handle error messages
-                        future = self.pending_requests.pop(request_id)
-                        future.set_exception(Exception(data.get("message", "Unknown error")))
-                except json.JSONDecodeError as e:
-                    logger.error(f"Error decoding JSON from WebSocket: {str(e)}")
+            while True:
+                message = await websocket.recv(decode=False)
+                
+                # Late replies to requests that timed out, and messages the relay
+                # broadcasts, can still arrive; there is nothing to parse while
+                # none of our requests is pending
+                if not self.pending_requests and not self.stream_requests:
+                    continue
+                
+                # Late replies and results for other requests are dropped before
+                # the frame is parsed
+                if self.active_encoding == "json":
+                    request_id = peek_request_id(message)
+                    if (request_id is not None and request_id not in self.pending_requests
+                            and request_id not in self.stream_requests):
+                        continue
+                
+                await inbox.put(message)
         except websockets.exceptions.ConnectionClosed:
-            logger.warning("WebSocket connection closed")
+            if self.connected:
+                logger.warning("WebSocket connection closed")
             self.connected = False
-            # Reject all pending requests
-            for request_id, future in list(self.pending_requests.items()):
-                if not future.done():
-                    future.set_exception(Exception("WebSocket connection closed"))
-            self.pending_requests.clear()
+            await inbox.put(Exception("WebSocket connection closed"))
         except Exception as e:
             logger.error(f"Error in WebSocket listener: {str(e)}")
             self.connected = False
-            # Reject all pending requests
-            for request_id, future in list(self.pending_requests.items()):
-                if not future.done():
-                    future.set_exception(Exception(f"WebSocket listener error: {str(e)}"))
-            self.pending_requests.clear()
-
-    async def send_request(self, request_type, **kwargs):
-        """Send a request to the Jupyter notebook and get the result"""
+            await inbox.put(Exception(f"WebSocket listener error: {str(e)}"))
+    
+    async def _process_messages(self, inbox):
+        """Background task to decode frames from the inbox and resolve their requests"""
+        while True:
+            message = await inbox.get()
+            if isinstance(message, Exception):
+                # The connection is gone; fail whatever is still pending
+                self._reject_pending(message)
+                return
+            
+            try:
+                items = self._decode_frame(message)
+                for item in items:
+                    if not isinstance(item, dict):
+                        logger.error(f"Ignoring malformed message from WebSocket: {item!r:.200}")
+                        continue
+                    # Resolve the future registered for this request, if any.
+                    # Frames for other clients or late replies are ignored.
+                    request_id = item.get("request_id")
+                    events = self.stream_requests.get(request_id)
+                    if events is not None:
+                        events.put_nowait(item)
+                        continue
+                    future = self.pending_requests.get(request_id)
+                    if future is None:
+                        continue
+                    raw = request_id in self.raw_requests
+                    self._forget_request(request_id)
+                    if future.done():
+                        continue
+                    if raw:
+                        # A lone JSON frame is the result itself, pass it on as received
+                        if len(items) == 1 and self.active_encoding == "json":
+                            item = message.decode()
+                        else:
+                            item = dumps(item).decode()
+                    future.set_result(item)
+            except ValueError as e:
+                logger.error(f"Error decoding message from WebSocket: {str(e)}")
+            except Exception:
+                # This is the only worker; a bad frame must not stop it, or
+                # every later request would hang until it timed out
+                logger.exception("Error handling message from WebSocket")
+    
+    def _register_request(self, request_id, raw, deadline):
+        """Create the future a request's result is delivered to"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending_requests[request_id] = future
+        if raw:
+            self.raw_requests.add(request_id)
+        self._request_deadlines[request_id] = deadline
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_pending_requests())
+        return future
+    
+    def _forget_request(self, request_id):
+        """Drop the bookkeeping kept for a request"""
+        self.pending_requests.pop(request_id, None)
+        self.raw_requests.discard(request_id)
+        self._request_deadlines.pop(request_id, None)
+    
+    def _reject_pending(self, error):
+        """Fail every pending request with the given error"""
+        for future in self.pending_requests.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending_requests.clear()
+        self.raw_requests.clear()
+        self._request_deadlines.clear()
+        for events in self.stream_requests.values():
+            events.put_nowait(error)
+    
+    async def _sweep_pending_requests(self):
+        """Background task dropping pending requests well past their timeout
+        
+        Covers requests whose caller went away without cleaning up, so a stuck
+        call cannot keep its entry alive forever.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(PENDING_SWEEP_INTERVAL)
+            now = loop.time()
+            for request_id, deadline in list(self._request_deadlines.items()):
+                if deadline < now:
+                    future = self.pending_requests.get(request_id)
+                    self._forget_request(request_id)
+                    if future is not None:
+                        future.cancel()
+
+    async def send_request(self, request_type, raw=False, timeout=None, **kwargs):
+        """Send a request to the Jupyter notebook and get the result
+        
+        With raw=True the result is returned as compact JSON text, forwarded as
+        received when possible, instead of a dict. timeout defaults to the
+        value in REQUEST_TIMEOUTS for the request type.
+        """
+        return await self._send({"type": request_type, **kwargs}, raw, timeout)
+    
+    def _touch(self):
+        """Record that a pooled client is in use, so it is not recycled as idle"""
+        if self in _pool_last_used:
+            _pool_last_used[self] = asyncio.get_running_loop().time()
+    
+    async def _send(self, request, raw=False, timeout=None):
+        """Send a request dict to the Jupyter notebook and get the result
+        
+        The dict holds the type and arguments of the request; its routing
+        fields and request_id are filled in when it is encoded. raw and timeout
+        work as in send_request. The timeout starts once the request has an
+        in-flight slot and covers any reconnect as well as the wait for the
+        result.
+        """
+        request_type = request["type"]
+        if request_type not in READ_ONLY_REQUESTS:
+            # Reads already in flight may not see this change
+            self._shared_reads.clear()
+        if timeout is None:
+            timeout = REQUEST_TIMEOUTS.get(request_type, DEFAULT_REQUEST_TIMEOUT)
+        loop = asyncio.get_running_loop()
+        self._touch()
+        
+        try:
+            # Requests queued behind a burst wait for a slot before their
+            # deadline starts, so they are not timed out before being sent
+            async with self._in_flight:
+                deadline = loop.time() + timeout
+                async with asyncio.timeout_at(deadline):
+                    return await self._send_and_wait(request, raw, deadline + timeout)
+        except TimeoutError:
+            logger.error(f"Request {request_type} timed out after {timeout:g} seconds")
+            # A slow reply says nothing about the connection, which other requests
+            # may still be using; keepalive pings detect a dead one
+            raise Exception(f"Request {request_type} timed out after {timeout:g} seconds")
+    
+    async def _shared_read(self, request):
+        """Send a read-only request, or join an identical one already in flight"""
+        key = dumps(request)
+        task = self._shared_reads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._send(request))
+            self._shared_reads[key] = task
+            
+            def done(task):
+                if self._shared_reads.get(key) is task:
+                    del self._shared_reads[key]
+                # Retrieve the error so it is not reported when every caller left
+                if not task.cancelled():
+                    task.exception()
+            
+            task.add_done_callback(done)
+        # A caller that is cancelled leaves the read running for the others
+        return await asyncio.shield(task)
+    
+    async def _send_and_wait(self, request, raw, sweep_deadline):
+        """Send a request, reconnecting once if needed, and wait for its result
+        
+        Runs under the deadline set by _send; sweep_deadline is the loop time
+        after which the sweeper may drop the request.
+        """
         # First check connection and reconnect if needed
         if not self.connected:
             logger.info("Connection lost, attempting to reconnect...")
-            success = await self.connect()
+            success = await self.reconnect()
             if not success:
                 raise Exception("Could not connect to Jupyter WebSocket server")
         
         # Create a unique request ID
-        request_id = f"req_{id(request_type)}_{asyncio.get_event_loop().time()}"
+        self._next_id += 1
+        request_id = self._next_id
         
         # Create a future to wait for the result
-        future = asyncio.get_event_loop().create_future()
-        self.pending_requests[request_id] = future
+        future = self._register_request(request_id, raw, sweep_deadline)
         
-        # Prepare the request with explicit direction
-        request = {
-            "type": request_type,
-            "source": "external",
-            "target": "notebook",
-            "request_id": request_id,
-            **kwargs
-        }
-        
-        # Send the request, with retry on connection error
+        # The caller may be cancelled at any point (an MCP client going away, or
+        # the deadline passing); drop the request then instead of leaving it
+        # pending. A late reply is discarded.
         try:
-            await self.websocket.send(json.dumps(request))
-        except websockets.exceptions.ConnectionClosed:
-            logger.warning("Connection closed when trying to send request, attempting to reconnect...")
-            self.connected = False
-            success = await self.connect()
-            if not success:
-                self.pending_requests.pop(request_id, None)
-                raise Exception("Connection lost and reconnect failed")
+            # Send the request, with retry on connection error
+            try:
+                await self._send_message(request, request_id)
+            except websockets.exceptions.ConnectionClosed:
+                logger.warning("Connection closed when trying to send request, attempting to reconnect...")
+                self.connected = False
+                # Reconnecting fails the requests of the old connection; keep this one
+                # out of them and register it again once connected
+                self._forget_request(request_id)
+                success = await self.reconnect()
+                if not success:
+                    raise Exception("Connection lost and reconnect failed")
+                future = self._register_request(request_id, raw, sweep_deadline)
+                
+                # Try sending again
+                try:
+                    await self._send_message(request, request_id)
+                except Exception as e:
+                    self._forget_request(request_id)
+                    raise Exception(f"Failed to send request after reconnect: {str(e)}")
             
-            # Try sending again
+            return await future
+        except asyncio.CancelledError:
+            self._forget_request(request_id)
+            future.cancel()
+            raise
+    
+    async def stream_request(self, request_type, timeout=None, **kwargs):
+        """Send a request the notebook answers with several events, and yield them
+        
+        Events with status "running" report progress; the first event with any
+        other status is the final result and ends the stream. Like _send, the
+        stream holds an in-flight slot, and timeout covers the whole stream
+        from the moment it gets one.
+        """
+        self._shared_reads.clear()
+        if timeout is None:
+            timeout = REQUEST_TIMEOUTS.get(request_type, DEFAULT_REQUEST_TIMEOUT)
+        self._touch()
+        loop = asyncio.get_running_loop()
+        
+        async with self._in_flight:
+            deadline = loop.time() + timeout
+            request_id = None
             try:
-                await self.websocket.send(json.dumps(request))
-            except Exception as e:
-                self.pending_requests.pop(request_id, None)
-                raise Exception(f"Failed to send request after reconnect: {str(e)}")
+                # The deadline only wraps the awaits inside the generator, so
+                # it never fires while the caller handles an event
+                async with asyncio.timeout_at(deadline):
+                    if not self.connected and not await self.reconnect():
+                        raise Exception("Could not connect to Jupyter WebSocket server")
+                    self._next_id += 1
+                    request_id = self._next_id
+                    events = self.stream_requests[request_id] = asyncio.Queue()
+                    await self._send_message({"type": request_type, "stream": True, **kwargs}, request_id)
+                while True:
+                    async with asyncio.timeout_at(deadline):
+                        event = await events.get()
+                    if isinstance(event, Exception):
+                        raise event
+                    yield event
+                    self._touch()
+                    if event.get("status") != "running":
+                        return
+            except TimeoutError:
+                logger.error(f"Request {request_type} timed out after {timeout:g} seconds")
+                raise Exception(f"Request {request_type} timed out after {timeout:g} seconds")
+            finally:
+                self.stream_requests.pop(request_id, None)
+    
+    async def batch(self, requests, raw=False):
+        """Send several requests at once and return their results in order
         
-        # Wait for the result with a timeout
-        try:
-            result = await asyncio.wait_for(future, 60.0)  # 60 second timeout
-            return result
-        except asyncio.TimeoutError:
-            self.pending_requests.pop(request_id, None)
-            logger.error(f"Request {request_type} timed out after 60 seconds")
-            # Connection might be stale, mark as disconnected so next request will reconnect
-            self.connected = False
-            raise Exception(f"Request {request_type} timed out after 60 seconds")
+        Each request is a dict with the request type and arguments, e.g.
+        {"type": "run_cell", "index": 1}. They are queued together, so they go
+        out in a single frame.
+        """
+        return await asyncio.gather(*(self._send(dict(request), raw) for request in requests))
     
     async def insert_and_execute_cell(
                 self,
@@ -146,86 +669,167 @@ class JupyterWebSocketClient:
                 slideshow_type=None
             ):
         """Insert a cell at the specified position and optionally set slideshow type"""
-        result = await self.send_request(
-            "insert_and_execute_cell", 
-            cell_type=cell_type, 
-            position=position, 
-            content=content,
-        )
+        result = await self._send({
+            "type": "insert_and_execute_cell",
+            "cell_type": cell_type,
+            "position": position,
+            "content": content,
+        })
         if (result.get("type") != "error") and slideshow_type:
             await self.set_slideshow_type(position, slideshow_type)
         return result
         
     async def save_notebook(self):
         """Save the current notebook"""
-        return await self.send_request("save_notebook")
+        return await self._send({"type": "save_notebook"})
     
     async def get_cells_info(self):
         """Get information about all cells in the notebook"""
-        return await self.send_request("get_cells_info")
+        return await self._shared_read({"type": "get_cells_info"})
     
     async def get_notebook_info(self):
         """Get information about the current notebook"""
-        return await self.send_request("get_notebook_info")
+        return await self._shared_read({"type": "get_notebook_info"})
+
+    async def get_state(self, fields=("notebook", "cells")):
+        """Get the notebook info and the cells info in a single response"""
+        return await self._shared_read({"type": "get_state", "fields": list(fields)})
 
-    async def run_cell(self, index=1):
+    async def run_cell(self, index=1, raw=False):
         """Run a specific cell by its index"""
-        return await self.send_request("run_cell", index=index)
+        return await self._send({"type": "run_cell", "index": index}, raw)
 
-    async def run_all_cells(self):
+    async def run_all_cells(self, raw=False):
         """Run all cells in the notebook"""
-        return await self.send_request("run_all_cells")
+        return await self._send({"type": "run_all_cells"}, raw)
+
+    def run_all_cells_stream(self):
+        """Run all cells in the notebook, yielding an event as each code cell finishes"""
+        return self.stream_request("run_all_cells")
 
-    async def get_cell_text_output(self, index, max_length=1500):
+    async def get_cell_text_output(self, index, max_length=1500, raw=False):
         """Get the output content of a specific cell by its index"""
-        return await self.send_request(
-            "get_cell_text_output", 
-            index=index,
-            max_length=max_length
-        )
+        return await self._send({
+            "type": "get_cell_text_output",
+            "index": index,
+            "max_length": max_length,
+        }, raw)
     
     async def get_image_output(self, index):
         """Get the image outputs of a specific cell by its index"""
-        return await self.send_request(
-            "get_cell_image_output", 
-            index=index
-        )
+        return await self._send({"type": "get_cell_image_output", "index": index})
 
-    async def edit_cell_content(self, index, content, execute=True):
+    async def edit_cell_content(self, index, content, execute=True, raw=False):
         """Edit the content of a specific cell by its index"""
-        return await self.send_request(
-            "edit_cell_content", 
-            source="external",
-            target="notebook",
-            index=index,
-            content=content,
-            execute=execute,
-        )
+        return await self._send({
+            "type": "edit_cell_content",
+            "index": index,
+            "content": content,
+            "execute": execute,
+        }, raw)
     
     async def set_slideshow_type(self, index, slideshow_type="-"):
         """Set the slideshow type for a specific cell by its index"""
-        return await self.send_request(
-            "set_slideshow_type", 
-            source="external",
-            target="notebook",
-            index=index,
-            slideshow_type=slideshow_type
-        )
-
-# Singleton client instance
-_jupyter_client: Optional[JupyterWebSocketClient] = None
-
-async def get_jupyter_client(host='localhost', port=8765):
-    """Get or create the Jupyter WebSocket client"""
-    global _jupyter_client
-    
-    if _jupyter_client is None:
-        _jupyter_client = JupyterWebSocketClient(host=host, port=port)
-        await _jupyter_client.connect()
-    elif not _jupyter_client.connected:
-        if host != _jupyter_client.host or port != _jupyter_client.port:
-            _jupyter_client.host = host
-            _jupyter_client.port = port
-        await _jupyter_client.connect()
-    
-    return _jupyter_client
+        return await self._send({
+            "type": "set_slideshow_type",
+            "index": index,
+            "slideshow_type": slideshow_type,
+        })
+
+# Pool of clients shared by concurrent tool calls. Each client still multiplexes
+# requests over its own connection; spreading calls over several connections
+# keeps a large result on one socket from delaying the others.
+DEFAULT_POOL_SIZE = 4
+
+# Pooled connections left idle for longer than this are closed, and reopened on
+# their next use (seconds)
+MAX_INACTIVE_CONNECTION_LIFETIME = 300.0
+
+_pool: list[JupyterWebSocketClient] = []
+_pool_lock = asyncio.Lock()
+_pool_index = 0
+_pool_last_used: dict[JupyterWebSocketClient, float] = {}
+_pool_settings = {"host": "localhost", "port": 8765, "encoding": "json", "uds": None, "size": DEFAULT_POOL_SIZE}
+_keepalive_task: Optional[asyncio.Task] = None
+
+async def _recycle_idle_clients():
+    """Background task closing pooled connections that have been idle for too long"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(MAX_INACTIVE_CONNECTION_LIFETIME / 4)
+        now = loop.time()
+        for client in list(_pool):
+            idle = now - _pool_last_used.get(client, now)
+            busy = client.pending_requests or client.stream_requests
+            if client.connected and not busy and idle > MAX_INACTIVE_CONNECTION_LIFETIME:
+                logger.info("Closing idle connection to Jupyter WebSocket server")
+                await client.disconnect()
+
+async def get_jupyter_client(host=None, port=None, encoding=None, pool_size=None, uds=None):
+    """Get a client from the pool, connecting it if needed
+    
+    Clients are handed out round-robin. Arguments left as None keep the
+    settings the pool already has; changing host, port, encoding or uds
+    replaces the pooled clients.
+    """
+    global _pool_index, _keepalive_task
+    
+    async with _pool_lock:
+        changed = False
+        for key, value in (("host", host), ("port", port), ("encoding", encoding), ("uds", uds)):
+            if value is not None and value != _pool_settings[key]:
+                _pool_settings[key] = value
+                changed = True
+        if pool_size is not None:
+            _pool_settings["size"] = max(1, pool_size)
+        
+        if changed:
+            for client in _pool:
+                await client.disconnect()
+            _pool.clear()
+            _pool_last_used.clear()
+        
+        while len(_pool) > _pool_settings["size"]:
+            client = _pool.pop()
+            _pool_last_used.pop(client, None)
+            await client.disconnect()
+        while len(_pool) < _pool_settings["size"]:
+            _pool.append(JupyterWebSocketClient(
+                host=_pool_settings["host"],
+                port=_pool_settings["port"],
+                encoding=_pool_settings["encoding"],
+                uds=_pool_settings["uds"],
+            ))
+        
+        client = _pool[_pool_index % len(_pool)]
+        _pool_index += 1
+        _pool_last_used[client] = asyncio.get_running_loop().time()
+        
+        if _keepalive_task is None or _keepalive_task.done():
+            _keepalive_task = asyncio.create_task(_recycle_idle_clients())
+    
+    # Connect outside the pool lock, so a slow or failing connection does not
+    # hold up callers given the other pooled clients
+    if not client.connected and not await client.connect():
+        raise Exception("Could not connect to Jupyter WebSocket server")
+    return client
+
+def has_open_client():
+    """Check, without awaiting, whether any pooled client has an open connection"""
+    return any(
+        client.connected and client.websocket is not None and client.websocket.state is State.OPEN
+        for client in _pool
+    )
+
+async def close_jupyter_clients():
+    """Disconnect every pooled client and stop the idle connection check"""
+    global _keepalive_task
+    
+    async with _pool_lock:
+        if _keepalive_task is not None:
+            _keepalive_task.cancel()
+            _keepalive_task = None
+        for client in _pool:
+            await client.disconnect()
+        _pool.clear()
+        _pool_last_used.clear()
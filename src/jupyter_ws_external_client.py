@@ -1,161 +1,318 @@
 import asyncio
+import base64
+import functools
+import hashlib
+import logging
+import os
+import sys
+import tempfile
 import websockets
-import json
 import argparse
-from jupyter_ws_client import get_jupyter_client
+from jupyter_ws_client import close_jupyter_clients, get_jupyter_client
+from jupyter_ws_json import dumps, dumps_pretty
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    # Gives the prompts line editing and history; not available on Windows
+    import readline  # noqa: F401
+except ImportError:
+    pass
+
+logger = logging.getLogger("JupyterExternalClient")
 
 DEFAULT_CELL_INDEX = 1
 
-async def external_client(host='localhost', port=8765):
+# Results whose JSON is larger than this are summarized instead of printed;
+# the full result is written to LAST_RESULT_PATH
+RENDER_LIMIT = 8192
+LAST_RESULT_PATH = os.path.join(tempfile.gettempdir(), "mcp-last.json")
+
+def run(main):
+    """Run a coroutine on uvloop when it is available, else on the default asyncio loop"""
+    if uvloop is not None:
+        return uvloop.run(main)
+    return asyncio.run(main)
+
+def render(result):
+    """Pretty-print a result, or summarize it when it is too large for the terminal"""
+    data = dumps(result)
+    if len(data) < RENDER_LIMIT:
+        return dumps_pretty(result)
+    
+    with open(LAST_RESULT_PATH, "wb") as f:
+        f.write(data)
+    keys = list(result)[:10] if isinstance(result, dict) else type(result).__name__
+    return f"<{len(data)} bytes, keys={keys}, full result in {LAST_RESULT_PATH}>"
+
+def show(result):
+    """Write a rendered result to stdout in a single write"""
+    sys.stdout.write(f"Result: {render(result)}\n")
+    sys.stdout.flush()
+
+def report(result):
+    """Print a batch test's status, logging the full result only when debugging"""
+    status = result.get("status") if isinstance(result, dict) else None
+    sys.stdout.write(f"Status: {status}\n")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Result: %s", render(result))
+
+def summarize_images(result, save_dir=None):
+    """Replace each image's data with a short summary, saving the decoded images to save_dir if given"""
+    images = result.get("images") if isinstance(result, dict) else None
+    if not images:
+        return result
+    
+    summary = []
+    for i, image in enumerate(images):
+        data = image.get("data", "")
+        image_format = image.get("format", "image/png")
+        # SVG outputs are plain text; the other formats are base64
+        is_svg = image_format == "image/svg+xml"
+        if save_dir:
+            path = os.path.join(save_dir, f"cell{result.get('index', 0)}_{i}.{'svg' if is_svg else image_format.split('/', 1)[-1]}")
+            with open(path, "wb") as f:
+                f.write(data.encode() if is_svg else base64.b64decode(data))
+            print(f"Saved {path}")
+        digest = hashlib.sha256(data.encode()).hexdigest()[:12]
+        summary.append({**image, "data": f"<{'svg' if is_svg else 'base64'} {len(data)} bytes, sha256={digest}>"})
+    return {**result, "images": summary}
+
+async def ainput(prompt):
+    """Read a line from the terminal without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(None, input, prompt)
+
+# Interactive client text, selected with --lang
+MESSAGES = {
+    "en": {
+        "menu": """
+=== MCP Jupyter TEST CLIENT ===
+1. Execute code
+2. Save notebook
+3. Get cells info
+4. Get notebook info
+5. Run specific cell
+6. Run all cells
+7. Get specific cell output
+8. Get specific cell image
+9. Edit specific cell content
+10. Set slideshow type for a cell
+0. Exit""",
+        "select_option": "Select an option: ",
+        "invalid_option": "Invalid option",
+        "code": "Enter the code to execute: ",
+        "position": "Position (optional, press Enter to finish): ",
+        "slideshow_types": "Valid types: slide, subslide, fragment, skip, notes, - (none)",
+        "slideshow_type": "Slideshow type: ",
+        "run_index": "Index of the cell to run: ",
+        "output_index": "Index of the cell to get output: ",
+        "max_length": "Maximum length (optional, press Enter for 1500): ",
+        "image_index": "Index of the cell to get images: ",
+        "edit_index": "Index of the cell to edit: ",
+        "new_content": "New content: ",
+        "execute_after_edit": "Execute after editing? (y/n): ",
+        "cell_index": "Cell index: ",
+        "connected": "Connected to WebSocket server at {address} ({encoding} frames)",
+        "connection_error": "Error in initial connection: {error}",
+        "connection_lost": "Connection lost. We will try to reconnect on the next command.",
+        "command_error": "Error executing command: {error}",
+    },
+    "es": {
+        "menu": """
+=== CLIENTE DE PRUEBA MCP Jupyter ===
+1. Ejecutar código
+2. Guardar notebook
+3. Obtener información de las celdas
+4. Obtener información del notebook
+5. Ejecutar una celda
+6. Ejecutar todas las celdas
+7. Obtener la salida de una celda
+8. Obtener la imagen de una celda
+9. Editar el contenido de una celda
+10. Establecer el tipo de diapositiva de una celda
+0. Salir""",
+        "select_option": "Selecciona una opción: ",
+        "invalid_option": "Opción no válida",
+        "code": "Introduce el código a ejecutar: ",
+        "position": "Posición (opcional, pulsa Enter para terminar): ",
+        "slideshow_types": "Tipos válidos: slide, subslide, fragment, skip, notes, - (ninguno)",
+        "slideshow_type": "Tipo de diapositiva: ",
+        "run_index": "Índice de la celda a ejecutar: ",
+        "output_index": "Índice de la celda de la que obtener la salida: ",
+        "max_length": "Longitud máxima (opcional, pulsa Enter para 1500): ",
+        "image_index": "Índice de la celda de la que obtener las imágenes: ",
+        "edit_index": "Índice de la celda a editar: ",
+        "new_content": "Nuevo contenido: ",
+        "execute_after_edit": "¿Ejecutar después de editar? (s/n): ",
+        "cell_index": "Índice de la celda: ",
+        "connected": "Conectado al servidor WebSocket en {address} (tramas {encoding})",
+        "connection_error": "Error en la conexión inicial: {error}",
+        "connection_lost": "Conexión perdida. Intentaremos reconectar en el siguiente comando.",
+        "command_error": "Error al ejecutar el comando: {error}",
+    },
+}
+
+# Answers to yes/no prompts that count as yes, in any of the languages above
+YES_ANSWERS = ("y", "s")
+
+async def handle_execute(client, text):
+    code = await ainput(text["code"])
+    pos_input = await ainput(text["position"])
+    position = int(pos_input) if pos_input.strip() else None
+    print(text["slideshow_types"])
+    slideshow_type = await ainput(text["slideshow_type"])
+    result = await client.insert_and_execute_cell("code", position, code, slideshow_type)
+    show(result)
+    
+    if slideshow_type.strip() != "":
+        result_slide = await client.set_slideshow_type(position, slideshow_type)
+        show(result_slide)
+
+async def handle_save(client, text):
+    result = await client.save_notebook()
+    show(result)
+
+async def handle_cells_info(client, text):
+    result = await client.get_cells_info()
+    show(result)
+
+async def handle_notebook_info(client, text):
+    result = await client.get_notebook_info()
+    show(result)
+
+async def handle_run_cell(client, text):
+    index = int(await ainput(text["run_index"]))
+    result = await client.run_cell(index)
+    show(result)
+
+async def handle_run_all(client, text):
+    # Print each cell's result as soon as it has run
+    async for event in client.run_all_cells_stream():
+        show(event)
+
+async def handle_text_output(client, text):
+    index = int(await ainput(text["output_index"]))
+    max_len_input = await ainput(text["max_length"])
+    max_length = int(max_len_input) if max_len_input.strip() else 1500
+    result = await client.get_cell_text_output(index, max_length)
+    show(result)
+
+async def handle_image_output(client, text, save_images=None):
+    index = int(await ainput(text["image_index"]))
+    result = await client.get_image_output(index)
+    show(summarize_images(result, save_images))
+
+async def handle_edit(client, text):
+    index = int(await ainput(text["edit_index"]))
+    content = await ainput(text["new_content"])
+    execute_input = (await ainput(text["execute_after_edit"])).lower()
+    execute = execute_input.startswith(YES_ANSWERS)
+    result = await client.edit_cell_content(index, content, execute)
+    show(result)
+
+async def handle_slideshow(client, text):
+    index = int(await ainput(text["cell_index"]))
+    print(text["slideshow_types"])
+    slideshow_type = await ainput(text["slideshow_type"])
+    if slideshow_type.strip() == "":
+        slideshow_type = "-"
+    result = await client.set_slideshow_type(index, slideshow_type)
+    show(result)
+
+async def handle_invalid(client, text):
+    print(text["invalid_option"])
+
+# Menu option -> handler; "0" exits the menu loop
+HANDLERS = {
+    "1": handle_execute,
+    "2": handle_save,
+    "3": handle_cells_info,
+    "4": handle_notebook_info,
+    "5": handle_run_cell,
+    "6": handle_run_all,
+    "7": handle_text_output,
+    "8": handle_image_output,
+    "9": handle_edit,
+    "10": handle_slideshow,
+}
+
+async def external_client(host='localhost', port=8765, save_images=None, encoding="json", lang="en", uds=None):
+        text = MESSAGES[lang]
         
         try:
-            client = await get_jupyter_client(host, port)
-            print(f"Connected to WebSocket server at {host}:{port}")
+            client = await get_jupyter_client(host, port, encoding, uds=uds)
+            print(text["connected"].format(address=f"{host}:{port}", encoding=client.active_encoding))
         except Exception as e:
-            print(f"Error in initial connection: {e}")
+            print(text["connection_error"].format(error=e))
             return
+        
+        handlers = {**HANDLERS, "8": functools.partial(handle_image_output, save_images=save_images)}
         # Interactive menu
         while True:
-            print("\n=== MCP Jupyter TEST CLIENT ===")
-            print("1. Execute code")
-            print("2. Save notebook")
-            print("3. Get cells info")
-            print("4. Get notebook info")
-            print("5. Run specific cell")
-            print("6. Run all cells")
-            print("7. Get specific cell output")
-            print("8. Get specific cell image")
-            print("9. Edit specific cell content")
-            print("10. Set slideshow type for a cell")
-            print("0. Exit")
-            
-            choice = input("Select an option: ")
+            sys.stdout.write(text["menu"] + "\n")
+            choice = await ainput(text["select_option"])
             
             if choice == "0":
                 break
             
+            # The client reconnects by itself, with backoff, when a request finds
+            # the connection down
             try:
-                if not client.connected:
-                    print("Connection lost, trying to reconnect...")
-                    try:
-                        await client.connect()
-                        print("Reconnected successfully")
-                    except Exception as e:
-                        print(f"Failed to reconnect: {e}")
-                        try:
-                            client = await get_jupyter_client(host, port)
-                            print("Created new client connection")
-                        except Exception as e2:
-                            print(f"Failed to create new connection: {e2}")
-                            continue
-                if choice == "1":
-                    code = input("Enter the code to execute: ")
-                    pos_input = input("Position (optional, press Enter to finish): ")
-                    position = int(pos_input) if pos_input.strip() else None
-                    print("Valid types: slide, subslide, fragment, skip, notes, - (none)")
-                    slideshow_type = input("Slideshow type: ")
-                    result = await client.insert_and_execute_cell("code", position, code, slideshow_type)
-                    print("Result:", json.dumps(result, indent=2))
-                    
-                    if slideshow_type.strip() != "":
-                        result_slide = await client.set_slideshow_type(position, slideshow_type)
-                        print("Result:", json.dumps(result_slide, indent=2))
-                elif choice == "2":
-                    result = await client.save_notebook()
-                    print("Result:", json.dumps(result, indent=2))
-                elif choice == "3":
-                    result = await client.get_cells_info()
-                    print("Result:", json.dumps(result, indent=2))
-                elif choice == "4":
-                    result = await client.get_notebook_info()
-                    print("Result:", json.dumps(result, indent=2))
-                elif choice == "5":
-                    index = int(input("Index of the cell to run: "))
-                    result = await client.run_cell(index)
-                    print("Result:", json.dumps(result, indent=2))
-                elif choice == "6":
-                    result = await client.run_all_cells()
-                    print("Result:", json.dumps(result, indent=2))
-                elif choice == "7":
-                    index = int(input("Index of the cell to get output: "))
-                    max_len_input = input("Maximum length (optional, press Enter for 1500): ")
-                    max_length = int(max_len_input) if max_len_input.strip() else 1500
-                    result = await client.get_cell_text_output(index, max_length)
-                    print("Result:", json.dumps(result, indent=2))
-                elif choice == "8":
-                    index = int(input("Index of the cell to get images: "))
-                    result = await client.get_image_output(index)
-                    print("Result:", json.dumps(result, indent=2))
-                elif choice == "9":
-                    index = int(input("Index of the cell to edit: "))
-                    content = input("New content: ")
-                    execute_input = input("Execute after editing? (y/n): ").lower()
-                    execute = execute_input.startswith('y')
-                    result = await client.edit_cell_content(index, content, execute)
-                    print("Result:", json.dumps(result, indent=2))
-                elif choice == "10":
-                    index = int(input("Cell index: "))
-                    print("Valid types: slide, subslide, fragment, skip, notes, - (none)")
-                    slideshow_type = input("Slideshow type: ")
-                    if slideshow_type.strip() == "":
-                        slideshow_type = "-"
-                    result = await client.set_slideshow_type(index, slideshow_type)
-                    print("Result:", json.dumps(result, indent=2))
-                else:
-                    print("Invalid option")
+                await handlers.get(choice, handle_invalid)(client, text)
             except websockets.exceptions.ConnectionClosed:
-                print("Connection lost. We will try to reconnect on the next command.")
+                print(text["connection_lost"])
             except Exception as e:
-                print(f"Error executing command: {e}")
-        
-        if client.connected:
-            await client.disconnect()
+                print(text["command_error"].format(error=e))
 
-async def execute_batch_tests(host='localhost', port=8765):
+async def execute_batch_tests(host='localhost', port=8765, save_images=None, encoding="json", uds=None):
     """Executes a series of automatic tests for all commands"""
-    uri = f"ws://localhost:{port}"
+    uri = f"ws://{host}:{port}"
     print(f"Starting automatic tests at {uri}")
     
     try:
-        client = await get_jupyter_client(host, port)
-        print(f"Connected to WebSocket server at {host}:{port}")
+        client = await get_jupyter_client(host, port, encoding, uds=uds)
+        print(f"Connected to WebSocket server at {host}:{port} ({client.active_encoding} frames)")
         
         # 1. Test code execution
         print("\n=== TEST: Execute code ===")
         code_result = await client.insert_and_execute_cell("code", DEFAULT_CELL_INDEX, "print('MCP Jupyter test')")
-        print("Result:", json.dumps(code_result, indent=2))
+        report(code_result)
         
-        # 2. Test getting notebook info
-        print("\n=== TEST: Get notebook info ===")
-        notebook_info = await client.get_notebook_info()
-        print("Result:", json.dumps(notebook_info, indent=2))
+        # 2-3. Test getting notebook and cells info, fetched in one request
+        # before anything restarts the kernel
+        print("\n=== TEST: Get notebook state ===")
+        state = await client.get_state()
+        report(state)
+        has_cells = state.get("status") == "success" and len(state.get("cells", [])) > 0
         
-        # 3. Test getting cells info
-        print("\n=== TEST: Get cells info ===")
-        cells_info = await client.get_cells_info()
-        print("Result:", json.dumps(cells_info, indent=2))
-        
-        # 4. Test running a specific cell
-        if cells_info.get("status") == "success" and len(cells_info.get("cells", [])) > 0:
+        # 4-5. Test running the cell inserted above and reading its output,
+        # before the image test inserts another cell at the same index
+        if has_cells:
             print("\n=== TEST: Run specific cell ===")
-            run_cell_result = await client.run_cell(DEFAULT_CELL_INDEX)
-            print("Result:", json.dumps(run_cell_result, indent=2))
-
+            report(await client.run_cell(DEFAULT_CELL_INDEX))
             print("\n=== TEST: Get cell output ===")
-            output_result = await client.get_cell_text_output(DEFAULT_CELL_INDEX)
-            print("Result:", json.dumps(output_result, indent=2))
+            report(await client.get_cell_text_output(DEFAULT_CELL_INDEX))
         
-        # 5. Test saving notebook
-        print("\n=== TEST: Save notebook ===")
-        save_result = await client.save_notebook()
-        print("Result:", json.dumps(save_result, indent=2))
+        # 6-7. Test saving the notebook and running all cells. Neither depends
+        # on the other, so they run as tasks of one group and each result is
+        # shown as soon as it arrives; a failure cancels the other task.
+        async def run_test(name, request):
+            return name, await request
         
-        # 6. Test running all cells
-        print("\n=== TEST: Run all cells ===")
-        run_all_result = await client.run_all_cells()
-        print("Result:", json.dumps(run_all_result, indent=2))
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(run_test("Save notebook", client.save_notebook())),
+                tg.create_task(run_test("Run all cells", client.run_all_cells())),
+            ]
+            for next_result in asyncio.as_completed(tasks):
+                name, result = await next_result
+                print(f"\n=== TEST: {name} ===")
+                report(result)
 
-        # 7. Test getting image from a cell
+        # 8. Test getting image from a cell; the image is read after the cell ran
         print("\n=== TEST: Get image from a cell ===")
         code_result = await client.insert_and_execute_cell(
             "code",
@@ -166,32 +323,53 @@ Image("../assets/img/notebook-setup.png")
             """
         )
         get_image_output_result = await client.get_image_output(DEFAULT_CELL_INDEX)
-        print("Result:", json.dumps(get_image_output_result, indent=2))
+        report(summarize_images(get_image_output_result, save_images))
         
-        # Test editing cell content
-        if cells_info.get("status") == "success" and len(cells_info.get("cells", [])) > 0:
+        # 9-10. Test editing (and re-running) the image cell and setting its
+        # slideshow type, one after the other since both touch the same cell
+        if has_cells:
             print("\n=== TEST: Edit cell content ===")
-            edit_result = await client.edit_cell_content(DEFAULT_CELL_INDEX, "# Cell modified by MCP\nprint('MCP was here :)')")
-            print("Result:", json.dumps(edit_result, indent=2))
-        
-        # Test setting slideshow type
-        if cells_info.get("status") == "success" and len(cells_info.get("cells", [])) > 0:
+            report(await client.edit_cell_content(
+                DEFAULT_CELL_INDEX, "# Cell modified by MCP\nprint('MCP was here :)')", True))
             print("\n=== TEST: Set slideshow type ===")
-            slideshow_result = await client.set_slideshow_type(DEFAULT_CELL_INDEX, "slide")
-            print("Result:", json.dumps(slideshow_result, indent=2))
+            report(await client.set_slideshow_type(DEFAULT_CELL_INDEX, "slide"))
 
         print("\n=== ALL TESTS COMPLETED ===")
     except Exception as e:
+        # A test that failed inside the task group is wrapped in an ExceptionGroup
+        while isinstance(e, ExceptionGroup):
+            e = e.exceptions[0]
         print(f"Error during tests: {str(e)}")
 
-if __name__ == "__main__":
+def parse_args(argv=None):
+    """Parse the test client's command line options"""
     parser = argparse.ArgumentParser(description="MCP Jupyter test client")
     parser.add_argument("--host", type=str, default="localhost", help="WebSocket server host")
     parser.add_argument("--port", type=int, default=8765, help="WebSocket server port")
     parser.add_argument("--batch", action="store_true", help="Run batch automatic tests")
-    args = parser.parse_args()
+    parser.add_argument("--save-images", metavar="DIR", help="Save images returned by the notebook to this directory")
+    parser.add_argument("--binary", action="store_true", help="Ask the server for MessagePack frames instead of JSON (needs msgpack)")
+    parser.add_argument("--uds", metavar="PATH", help="Connect through the server's Unix socket at PATH when it exists")
+    parser.add_argument("--verbose", action="store_true", help="Log the full result of each batch test")
+    parser.add_argument("--lang", choices=sorted(MESSAGES), default="en", help="Language of the interactive menu")
+    return parser.parse_args(argv)
+
+async def main(args):
+    """Run the interactive client or the batch tests over one shared connection"""
+    encoding = "msgpack" if args.binary else "json"
+    try:
+        if args.batch:
+            await execute_batch_tests(args.host, args.port, args.save_images, encoding, args.uds)
+        else:
+            await external_client(args.host, args.port, args.save_images, encoding, args.lang, args.uds)
+    finally:
+        await close_jupyter_clients()
+
+if __name__ == "__main__":
+    args = parse_args()
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    
+    if args.save_images:
+        os.makedirs(args.save_images, exist_ok=True)
     
-    if args.batch:
-        asyncio.run(execute_batch_tests(args.host, args.port))
-    else:
-        asyncio.run(external_client(args.host, args.port))
+    run(main(args))
@@ -0,0 +1,54 @@
+"""
+JSON helpers shared by the Jupyter WebSocket server and its clients.
+
+Uses orjson when it is installed, then ujson, and falls back to the standard
+library otherwise. `dumps` always returns bytes, which websockets can send
+as-is; `dumps_pretty` returns indented text for responses meant to be read.
+"""
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if orjson is not None:
+    loads = orjson.loads
+    dumps = orjson.dumps
+    JSONDecodeError = orjson.JSONDecodeError
+
+    def dumps_pretty(obj):
+        """Serialize an object to JSON text indented by two spaces"""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+elif ujson is not None:
+    loads = ujson.loads
+    JSONDecodeError = getattr(ujson, "JSONDecodeError", ValueError)
+
+    def dumps(obj):
+        """Serialize an object to compact JSON bytes"""
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode()
+
+    def dumps_pretty(obj):
+        """Serialize an object to JSON text indented by two spaces"""
+        return ujson.dumps(obj, indent=2, ensure_ascii=False, escape_forward_slashes=False)
+else:
+    import json
+
+    loads = json.loads
+    JSONDecodeError = json.JSONDecodeError
+
+    # Encoders are configured once instead of on every json.dumps call
+    _encode_compact = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+    _encode_pretty = json.JSONEncoder(indent=2, ensure_ascii=False).encode
+
+    def dumps(obj):
+        """Serialize an object to compact JSON bytes"""
+        return _encode_compact(obj).encode()
+
+    def dumps_pretty(obj):
+        """Serialize an object to JSON text indented by two spaces"""
+        return _encode_pretty(obj)
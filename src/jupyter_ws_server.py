@@ -4,142 +4,488 @@ to enable MCP integration with LLMs
 """
 
 import asyncio
-import nest_asyncio
-import json
+import errno
+import logging
 import os
+import socket
+import stat
+import websockets
 from IPython.display import display, HTML
+from jupyter_ws_json import dumps, loads
 
-# Apply nest_asyncio to allow async code in IPython
-nest_asyncio.apply()
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-# WebSocket server setup for Jupyter integration
-def setup_jupyter_mcp_integration(ws_port=8765, max_port_attempts=10):
+logger = logging.getLogger("JupyterWebSocketServer")
+
+# Maximum number of queued frames merged into a single outbound message
+MAX_COALESCED_FRAMES = 64
+
+# Time a writer waits for more frames before sending a lone queued frame (seconds)
+FLUSH_INTERVAL = 0.001
+
+# Outbound messages larger than this are sent as a fragmented message, in
+# slices of this size, instead of being concatenated into one buffer
+FRAGMENT_SIZE = 2**16
+
+# Connection options for the relay: no limit on queued incoming frames, room for
+# large cell outputs, and no per-message compression of small JSON messages
+# unless setup asks for it
+WS_SERVER_OPTIONS = {
+    "max_queue": None,
+    "max_size": 2**26,
+    "write_limit": 2**20,
+    "compression": None,
+}
+
+# client.js is read once at import time; the port placeholder is filled in per setup
+CLIENT_JS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "client.js")
+CLIENT_JS_PORT_PLACEHOLDER = "__WS_PORT__"
+
+try:
+    with open(CLIENT_JS_PATH, "r") as f:
+        _CLIENT_JS_TEMPLATE = f"""
+        <script>
+        {f.read()}
+        </script>
+        """
+except FileNotFoundError:
+    _CLIENT_JS_TEMPLATE = None
+
+def iter_fragments(batch):
+    """Yield the frames of a batch as message fragments without copying them"""
+    if len(batch) > 1:
+        yield b"["
+    for i, frame in enumerate(batch):
+        if i:
+            yield b","
+        view = memoryview(frame)
+        for start in range(0, len(view), FRAGMENT_SIZE):
+            yield view[start:start + FRAGMENT_SIZE]
+    if len(batch) > 1:
+        yield b"]"
+
+async def client_writer(websocket, queue, encoding="json", text=True):
+    """Send queued frames to a client, merging bursts into one JSON array frame
+    
+    Frames are queued already encoded. For clients that negotiated
+    MessagePack, a batch is sent as one binary frame holding the concatenated
+    MessagePack objects. JSON goes out in text frames when text is set, as
+    the browser expects, and in binary frames otherwise.
     """
-    Set up the Jupyter notebook to work with MCP by:
-    1. Starting a WebSocket server in the notebook
-    2. Injecting client-side JavaScript to handle WebSocket connections
-    3. Providing instructions for connecting the MCP server
+    try:
+        while True:
+            batch = [await queue.get()]
+            if queue.empty():
+                await asyncio.sleep(FLUSH_INTERVAL)
+            size = len(batch[0])
+            while len(batch) < MAX_COALESCED_FRAMES and not queue.empty():
+                batch.append(queue.get_nowait())
+                size += len(batch[-1])
+            
+            if encoding == "msgpack":
+                await websocket.send(b"".join(batch))
+                continue
+            
+            if size > FRAGMENT_SIZE:
+                payload = iter_fragments(batch)
+            elif len(batch) == 1:
+                payload = batch[0]
+            else:
+                payload = b"[" + b",".join(batch) + b"]"
+            await websocket.send(payload, text=text)
+    except websockets.exceptions.ConnectionClosed:
+        # Stop queueing frames for this client right away
+        external_clients.pop(websocket, None)
+    except Exception as e:
+        # Without a writer the client's queue would only grow; drop the client
+        # and close its connection so it can reconnect
+        logger.error("Error sending to client: %s", e)
+        external_clients.pop(websocket, None)
+        await websocket.close(1011, "Server error while sending")
+
+# Connection state shared by the handler and the routes. external_clients maps
+# each external websocket to its outbound frame queue; notebook_queue holds
+# outbound frames for the notebook client.
+notebook_client = None
+notebook_queue = None
+external_clients = {}
+
+# External clients that negotiated MessagePack; their queues hold packed frames
+msgpack_clients = set()
+
+# External client waiting on each request forwarded to the notebook, so the
+# result goes back only to the connection that asked for it
+request_senders = {}
+
+# Servers for the localhost addresses after the first one, e.g. ::1 next to
+# 127.0.0.1, so clients reach the relay whichever address they resolve
+extra_servers = []
+
+# Server listening on the optional Unix domain socket
+unix_server = None
+
+# Pre-encoded reply for requests that arrive while no notebook is connected;
+# only the request_id is spliced in
+NO_NOTEBOOK_ERROR = (
+    b'{"type":"error","status":"error","source":"server","target":"external",'
+    b'"message":"No notebook client connected","request_id":%s}'
+)
+
+# Reply for requests still waiting on a notebook client that went away
+NOTEBOOK_GONE_ERROR = (
+    b'{"type":"error","status":"error","source":"server","target":"external",'
+    b'"message":"Notebook client disconnected","request_id":%s}'
+)
+
+def encode_for(client, payload, data=None):
+    """Encode a JSON frame for a client's queue, packing it for MessagePack clients
     
-    Args:
-        ws_port: Port for the WebSocket server (default: 8765)
-        max_port_attempts: Maximum number of alternative ports to try if the specified port is busy
+    data is the already parsed message when the caller has it, so it is not
+    parsed again.
     """
+    if client in msgpack_clients:
+        return msgpack.packb(loads(payload) if data is None else data)
+    return payload
+
+def fail_pending_requests():
+    """Answer every request forwarded to the notebook with an error and forget them"""
+    for request_id, sender in request_senders.items():
+        if sender in external_clients:
+            external_clients[sender].put_nowait(encode_for(sender, NOTEBOOK_GONE_ERROR % dumps(request_id)))
+    request_senders.clear()
+
+# Routing for each message target, looked up once per frame
+async def route_to_notebook(sender, data, payload):
+    """Forward a frame to the notebook client, or answer with an error if there is none"""
+    if notebook_client:
+        if sender in external_clients and "request_id" in data:
+            request_senders[data["request_id"]] = sender
+        notebook_queue.put_nowait(payload)
+    elif sender in external_clients:
+        external_clients[sender].put_nowait(encode_for(sender, NO_NOTEBOOK_ERROR % dumps(data.get("request_id"))))
+
+async def route_to_external(sender, data, payload):
+    """Queue a result for the client that asked for it, otherwise for every external client but the sender"""
+    # Streamed requests get progress events (status "running") before their result
+    if data.get("status") == "running":
+        requester = request_senders.get(data.get("request_id"))
+    else:
+        requester = request_senders.pop(data.get("request_id"), None)
+    if requester is not None:
+        if requester in external_clients:
+            external_clients[requester].put_nowait(encode_for(requester, payload, data))
+        return
     
-    # WebSocket server implementation
-    async def ws_handler(websocket):
-        """Handle WebSocket connections from clients"""
-        global notebook_client, external_clients
-        
+    # A broadcast is packed at most once for all MessagePack clients
+    packed = None
+    for client, queue in list(external_clients.items()):
+        if client == sender:
+            continue
+        if client in msgpack_clients:
+            if packed is None:
+                packed = msgpack.packb(data)
+            queue.put_nowait(packed)
+        else:
+            queue.put_nowait(payload)
+
+async def route_to_all(sender, data, payload):
+    """Broadcast a frame to all connected clients except the sender"""
+    await route_to_external(sender, data, payload)
+    if notebook_client and notebook_client != sender:
+        notebook_queue.put_nowait(payload)
+
+async def route_to_server(sender, data, payload):
+    """Message meant for the server itself, handle internally"""
+    pass
+
+TARGET_ROUTES = {
+    "notebook": route_to_notebook,
+    "external": route_to_external,
+    "all": route_to_all,
+    "server": route_to_server,
+}
+
+def iter_messages(frame, encoding):
+    """Yield (message, raw JSON frame or None) for each message a received frame carries
+    
+    Clients may batch messages like the server does: a JSON array frame, or
+    concatenated MessagePack objects. Only a frame holding a single JSON
+    message can be forwarded as it is.
+    """
+    if encoding == "msgpack":
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(frame)
+        for data in unpacker:
+            yield data, None
+        return
+    
+    data = loads(frame)
+    if isinstance(data, list):
+        for item in data:
+            yield item, None
+    else:
+        yield data, frame
+
+def bind_localhost(port):
+    """Bind and listen on every address localhost resolves to, usually 127.0.0.1 and ::1
+    
+    Addresses the machine cannot use, such as ::1 with IPv6 disabled, are
+    skipped; any other error closes the sockets bound so far and is raised.
+    """
+    socks = []
+    seen = set()
+    try:
+        for family, type_, proto, _, address in socket.getaddrinfo("localhost", port, type=socket.SOCK_STREAM):
+            if (family, address) in seen:
+                continue
+            seen.add((family, address))
+            sock = socket.socket(family, type_, proto)
+            socks.append(sock)
+            if os.name == "posix":
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            try:
+                sock.bind(address)
+            except OSError as e:
+                if e.errno != errno.EADDRNOTAVAIL:
+                    raise
+                socks.pop().close()
+                continue
+            sock.listen()
+    except OSError:
+        for sock in socks:
+            sock.close()
+        raise
+    if not socks:
+        raise OSError(f"No localhost address could be bound on port {port}")
+    return socks
+
+def bind_server_socket(port, max_attempts):
+    """Bind and listen on the given port, trying the next ports if it is busy
+    
+    Binding happens synchronously so the actual port is known before the
+    server is scheduled, and connections are queued by the OS until then.
+    Returns the listening sockets, one per localhost address, and the port.
+    """
+    attempt = 0
+    current_port = port
+    last_error = None
+    
+    while attempt < max_attempts:
         try:
-            # Initial message to identify client type
-            init_msg = await websocket.recv()
-            init_data = json.loads(init_msg)
-            client_role = init_data.get("role")
-            
-            if client_role == "notebook":
-                notebook_client = websocket
-                print("Jupyter client connected")
+            return bind_localhost(current_port), current_port
+        except OSError as e:
+            # Port is likely in use
+            if e.errno in (errno.EADDRINUSE, 10048):  # 10048 is the Windows error code for address in use
+                print(f"Port {current_port} is busy, trying next port...")
+                current_port += 1
+                attempt += 1
+                last_error = e
             else:
-                external_clients.add(websocket)
-                print("External client connected (likely MCP server)")
-            
-            async for message in websocket:
-                data = json.loads(message)
-                
+                # Different error, raise it
+                raise
+    
+    # If we get here, we've exhausted our attempts
+    raise OSError(f"Could not bind to any port after {max_attempts} attempts. Last error: {str(last_error)}")
+
+async def ws_handler(websocket):
+    """Handle WebSocket connections from clients"""
+    global notebook_client, notebook_queue
+    client_role = None
+    writer = None
+    
+    try:
+        # Initial message to identify client type
+        init_msg = await websocket.recv()
+        init_data = loads(init_msg)
+        client_role = init_data.get("role")
+        
+        # Clients may ask for MessagePack frames; answer with the encoding in use
+        encoding = "json"
+        if "encoding" in init_data:
+            if init_data["encoding"] == "msgpack" and msgpack is not None:
+                encoding = "msgpack"
+            await websocket.send(dumps({"type": "encoding_ack", "source": "server", "encoding": encoding}), text=True)
+        
+        if client_role == "notebook":
+            # A reloaded notebook replaces the old connection, which will
+            # never answer the requests it was sent
+            if notebook_client is not None:
+                fail_pending_requests()
+            notebook_client = websocket
+            notebook_queue = asyncio.Queue()
+            writer = asyncio.create_task(client_writer(websocket, notebook_queue))
+            logger.info("Jupyter client connected")
+        else:
+            queue = external_clients[websocket] = asyncio.Queue()
+            if encoding == "msgpack":
+                msgpack_clients.add(websocket)
+            # External clients read JSON from binary frames as well
+            writer = asyncio.create_task(client_writer(websocket, queue, encoding, text=False))
+            logger.info("External client connected (likely MCP server)")
+        
+        while True:
+            # Keep the raw frame so it can be forwarded without re-encoding
+            message = await websocket.recv(decode=False)
+            for data, raw in iter_messages(message, encoding):
                 # Route message based on explicit target field
                 target = data.get("target", "all")
                 
-                # Add source information to outgoing messages if not already present
-                if "source" not in data:
-                    data["source"] = client_role
-                
-                if target == "notebook" and notebook_client:
-                    await notebook_client.send(json.dumps(data))
-                elif target == "external":
-                    for client in external_clients:
-                        if client != websocket:
-                            await client.send(json.dumps(data))
-                elif target == "all":
-                    # Broadcast to all connected clients
-                    for client in list(external_clients) + ([notebook_client] if notebook_client else []):
-                        if client != websocket:
-                            await client.send(json.dumps(data))
-                elif target == "server":
-                    # Message meant for the server itself, handle internally
-                    pass
+                # Add source information to outgoing messages if not already present;
+                # otherwise the original JSON frame is forwarded untouched
+                if "source" in data and raw is not None:
+                    payload = raw
                 else:
-                    print(f"Unknown target: {target}")
-        
-        except Exception as e:
-            print(f"WebSocket error: {str(e)}")
-        
-        finally:
-            # Clean up when connection is closed
-            if websocket == notebook_client:
-                notebook_client = None
-                print("Notebook Client disconnected")
-            elif websocket in external_clients:
-                external_clients.remove(websocket)
-                print("External Client disconnected")
-    
-    # Start WebSocket server
-    async def start_server(port, max_attempts=max_port_attempts):
-        """Start the WebSocket server"""
-        import websockets
-        
-        # Try the specified port and incremental alternatives if busy
-        attempt = 0
-        current_port = port
-        last_error = None
-        
-        while attempt < max_attempts:
-            try:
-                server = await websockets.serve(ws_handler, "localhost", current_port)
-                print(f"WebSocket server started on ws://localhost:{current_port}")
-                return server, current_port
-            except OSError as e:
-                # Port is likely in use
-                if e.errno == 10048 or e.errno == 98:  # Windows or Linux error code for address in use
-                    print(f"Port {current_port} is busy, trying next port...")
-                    current_port += 1
-                    attempt += 1
-                    last_error = e
+                    data.setdefault("source", client_role)
+                    payload = dumps(data)
+                
+                route = TARGET_ROUTES.get(target)
+                if route is not None:
+                    await route(websocket, data, payload)
                 else:
-                    # Different error, raise it
-                    raise
-        
-        # If we get here, we've exhausted our attempts
-        raise OSError(f"Could not bind to any port after {max_attempts} attempts. Last error: {str(last_error)}")
+                    logger.debug("Unknown target: %s", target)
+    
+    except websockets.exceptions.ConnectionClosedOK:
+        pass
+    
+    except Exception as e:
+        logger.error("WebSocket error: %s", e)
     
-    # Read the client.js file
-    client_js_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "client.js")
+    finally:
+        # Clean up when connection is closed
+        if writer is not None:
+            writer.cancel()
+        if websocket == notebook_client:
+            notebook_client = None
+            notebook_queue = None
+            fail_pending_requests()
+            logger.info("Notebook Client disconnected")
+        elif writer is not None and client_role != "notebook":
+            external_clients.pop(websocket, None)
+            msgpack_clients.discard(websocket)
+            for request_id, sender in list(request_senders.items()):
+                if sender == websocket:
+                    del request_senders[request_id]
+            logger.info("External Client disconnected")
+
+async def start_server(socks, compression=None, uds_path=None):
+    """Start the WebSocket server on already bound sockets
+    
+    The server for the first socket is returned; the others, for the
+    remaining localhost addresses, are kept in extra_servers. With uds_path
+    the same handler also listens on a Unix domain socket at that path, for
+    clients on the same machine; the TCP server is returned and keeps
+    running if the Unix socket cannot be used.
+    """
+    global unix_server
+    options = {**WS_SERVER_OPTIONS, "compression": compression}
+    server, *others = [await websockets.serve(ws_handler, sock=sock, **options) for sock in socks]
+    extra_servers.extend(others)
+    if uds_path is not None:
+        unix_server = await start_unix_server(uds_path, options)
+    return server
+
+def remove_socket_file(path):
+    """Remove the socket file at path, leaving any other kind of file alone"""
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+
+async def start_unix_server(path, options):
+    """Listen on a Unix domain socket, reporting and returning None if that fails"""
     try:
-        with open(client_js_path, "r") as f:
-            client_js_content = f.read()
-        
-        # Format with port placeholder
-        client_js = f"""
-        <script>
-        {client_js_content}
-        </script>
-        """.replace("ws://localhost:%s", f"ws://localhost:{ws_port}")
-        print(f"Loaded client.js from {client_js_path}")
-    except FileNotFoundError:
-        print(f"Warning: client.js not found at {client_js_path}")
+        # A socket left by an earlier server would make the bind fail
+        remove_socket_file(path)
+        server = await websockets.unix_serve(ws_handler, path, **options)
+    except Exception as e:
+        logger.error("Could not listen on the Unix socket %s: %s", path, e)
+        print(f"Could not listen on the Unix socket {path}: {e}")
+        return None
+    print(f"External clients can also connect through the Unix socket {path}")
+    return server
+
+def close_unix_server():
+    """Close the Unix socket server, if any, and remove its socket file
+    
+    Clients try the socket whenever the file exists, so one outliving its
+    server would cost them a failed connect before they fall back to TCP.
+    """
+    global unix_server
+    if unix_server is None:
+        return
+    paths = [sock.getsockname() for sock in unix_server.sockets]
+    unix_server.close()
+    unix_server = None
+    for path in paths:
+        try:
+            remove_socket_file(path)
+        except OSError as e:
+            logger.warning("Could not remove the Unix socket %s: %s", path, e)
+
+# WebSocket server setup for Jupyter integration
+def setup_jupyter_mcp_integration(ws_port=8765, max_port_attempts=10, compression=None, uds_path=None):
+    """
+    Set up the Jupyter notebook to work with MCP by:
+    1. Starting a WebSocket server in the notebook
+    2. Injecting client-side JavaScript to handle WebSocket connections
+    3. Providing instructions for connecting the MCP server
+    
+    Args:
+        ws_port: Port for the WebSocket server (default: 8765)
+        max_port_attempts: Maximum number of alternative ports to try if the specified port is busy
+        compression: "deflate" to compress messages for clients that support it, which
+            pays off when the MCP server reaches the notebook over a network (default: None)
+        uds_path: Also listen on a Unix domain socket at this path, so an MCP server on the
+            same machine can skip the TCP stack (POSIX only, default: None)
+    
+    Returns:
+        A (server, port) tuple. When called from a running event loop, such as
+        a notebook cell, server is an asyncio.Task that resolves to the
+        websockets server once the loop picks it up. Otherwise the server is
+        started on a new event loop, which becomes the thread's current loop
+        and has to be run, e.g. with run_forever(), for the server to answer.
+    """
+    
+    # Make sure client.js was loaded
+    if _CLIENT_JS_TEMPLATE is None:
+        print(f"Warning: client.js not found at {CLIENT_JS_PATH}")
         print("Please ensure client.js is in the same directory as this script")
-        raise
+        raise FileNotFoundError(f"client.js not found at {CLIENT_JS_PATH}")
+    print(f"Loaded client.js from {CLIENT_JS_PATH}")
     
-    # Initialize global variables
-    global notebook_client, external_clients
+    # Reset the connection state
+    global notebook_client, notebook_queue, external_clients, msgpack_clients, request_senders
+    close_unix_server()
     notebook_client = None
-    external_clients = set()
+    notebook_queue = None
+    external_clients = {}
+    msgpack_clients = set()
+    request_senders = {}
+    
+    # Start the WebSocket server. Inside a notebook the kernel's event loop is
+    # already running, so the server is scheduled on it as a task instead of
+    # re-entering the loop.
+    socks, actual_port = bind_server_socket(ws_port, max_port_attempts)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
     
-    # Start the WebSocket server
-    loop = asyncio.get_event_loop()
-    server, actual_port = loop.run_until_complete(start_server(ws_port))
+    if loop is not None:
+        server = loop.create_task(start_server(socks, compression, uds_path))
+    else:
+        # Outside a running loop, start the server on a new loop that stays set
+        # as the thread's current loop, so the caller can keep running it
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(start_server(socks, compression, uds_path))
+    print(f"WebSocket server started on ws://localhost:{actual_port}")
     
-    # Update client_js with the actual port that was used
-    actual_client_js = client_js.replace(f"ws://localhost:{ws_port}", f"ws://localhost:{actual_port}")
+    # Fill in the port that was actually bound
+    actual_client_js = _CLIENT_JS_TEMPLATE.replace(CLIENT_JS_PORT_PLACEHOLDER, str(actual_port))
     
     # Add JavaScript to establish WebSocket connection in notebook
     display(HTML(actual_client_js))